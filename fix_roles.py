@@ -1,12 +1,22 @@
+import io
 import os
 import sys
 import argparse
+import logging
 import pymongo
+from pymongo import UpdateOne
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 from dotenv import load_dotenv
 from bson.objectid import ObjectId
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from enum import Enum
+from functools import lru_cache, partial
+from itertools import chain, islice
 
 # --- Configuration ---
 # Load environment variables from a .env file
@@ -15,6 +25,10 @@ load_dotenv()
 # MongoDB Configuration
 MONGO_URI = os.getenv("MONGO_URI")
 MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))
+# Wire compression for the large scans; zstd needs the pymongo[zstd] extra installed
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zstd")
 
 # PostgreSQL Configuration
 PG_HOST = os.getenv("PG_HOST")
@@ -22,270 +36,743 @@ PG_PORT = os.getenv("PG_PORT")
 PG_DB_NAME = os.getenv("PG_DB_NAME")
 PG_USER = os.getenv("PG_USER")
 PG_PASSWORD = os.getenv("PG_PASSWORD")
+PG_POOL_MIN_CONN = int(os.getenv("PG_POOL_MIN_CONN", "2"))
+PG_POOL_MAX_CONN = int(os.getenv("PG_POOL_MAX_CONN", "16"))
+
+log = logging.getLogger(__name__)
+
+# Number of documents fetched per round-trip when streaming large collections
+TEAMS_BATCH_SIZE = 1000
+ROLES_BATCH_SIZE = 1000
+MEMBERS_BATCH_SIZE = 5000
+# Number of threads auditing teams concurrently
+DEFAULT_WORKERS = 8
+# Columns of postgres_user_roles written for each created role, in row order
+PG_ROLE_COLUMNS = (
+    "mongo_id", "user_id", "role_name", "scope", "team_id",
+    "is_active", "created_at", "created_by", "sync_status", "last_sync_at",
+)
+# Role inserts of at least this many rows are loaded with COPY instead of INSERT
+COPY_MIN_ROWS = 100
 
 class TeamRole(Enum):
     OWNER = "owner"
     ADMIN = "admin"
     MEMBER = "member"
 
-def run_data_fix(dry_run=True):
+# Role names hoisted out of the Enum, in the order an owner's roles are created
+TEAM_ROLE_VALUES = tuple(role.value for role in TeamRole)
+MEMBER_ROLE = TeamRole.MEMBER.value
+# The exact role sets a correct creator and a correct member hold
+OWNER_ROLE_SET = frozenset(TEAM_ROLE_VALUES)
+MEMBER_ROLE_SET = frozenset((MEMBER_ROLE,))
+
+def iter_batches(iterable, size):
+    """
+    Yields lists of up to `size` consecutive items from `iterable`.
+
+    Args:
+        iterable (iterable): The items to group, e.g. a MongoDB cursor.
+        size (int): The maximum number of items per batch.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """
+    A PostgreSQL connection that prepares the script's per-row statements as
+    soon as it is opened, so the server parses and plans them only once per
+    connection instead of on every execution.
+    """
+
+    PREPARED_STATEMENTS = (
+        """
+            PREPARE delete_team_role AS
+            DELETE FROM postgres_user_roles
+            WHERE user_id=$1
+            AND team_id=$2
+            AND role_name=$3
+            AND scope=$4;
+        """,
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with self.cursor() as cursor:
+            for statement in self.PREPARED_STATEMENTS:
+                cursor.execute(statement)
+        self.commit()
+
+class TeamReport:
+    """
+    Collects one team's log messages inside a worker thread so the main thread
+    can emit them in team order. Messages below the enabled log level are
+    dropped before they are formatted.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, level, message, *args):
+        if log.isEnabledFor(level):
+            self.records.append((level, message % args))
+
+    def debug(self, message, *args):
+        self.add(logging.DEBUG, message, *args)
+
+    def error(self, message, *args):
+        self.add(logging.ERROR, message, *args)
+
+    def emit(self):
+        """Logs the collected messages through the module logger."""
+        for level, message in self.records:
+            log.log(level, message)
+
+# Database handles shared by every thread, set by open_connections()
+mongo_client = None
+mongo_supports_transactions = False
+pg_pool = None
+
+def open_connections():
+    """
+    Opens the MongoDB client and PostgreSQL connection pool. Both are thread-safe
+    and shared by every thread auditing teams.
+    """
+    global mongo_client, mongo_supports_transactions, pg_pool
+    mongo_client = pymongo.MongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        compressors=MONGO_COMPRESSORS,
+        retryWrites=True
+    )
+    # Ping so connection problems surface here, and so the deployment type is known:
+    # multi-document transactions need a replica set or sharded cluster.
+    mongo_client.admin.command('ping')
+    mongo_supports_transactions = mongo_client.topology_description.topology_type_name != 'Single'
+    pg_pool = psycopg2.pool.ThreadedConnectionPool(
+        minconn=PG_POOL_MIN_CONN,
+        maxconn=PG_POOL_MAX_CONN,
+        dbname=PG_DB_NAME,
+        user=PG_USER,
+        password=PG_PASSWORD,
+        host=PG_HOST,
+        port=PG_PORT,
+        connection_factory=PreparedConnection
+    )
+
+def close_connections():
+    """Closes the database handles opened by open_connections()."""
+    global mongo_client, pg_pool
+    if mongo_client:
+        mongo_client.close()
+        mongo_client = None
+        log.info("MongoDB connection closed.")
+    if pg_pool:
+        # Connections still checked out are rolled back when the pool is closed
+        pg_pool.closeall()
+        pg_pool = None
+        log.info("PostgreSQL connections closed.")
+
+def count_correct_roles(team, team_member_details, roles_by_user):
+    """
+    Checks whether every member of a team already has exactly the right roles:
+    all team roles for the creator, and only the member role for everyone else.
+
+    Args:
+        team (dict): The team document.
+        team_member_details (list): The team's user_team_details documents.
+        roles_by_user (dict): The team's active role documents, keyed by user_id.
+
+    Returns:
+        int: The number of correct roles if the team needs no changes, else None.
+    """
+    correct_roles = 0
+    for member in team_member_details:
+        role_names = {existing['role_name'] for existing in roles_by_user[member['user_id']]}
+        if member['user_id'] == team['created_by']:
+            if not OWNER_ROLE_SET <= role_names:
+                return None
+            correct_roles += len(TEAM_ROLE_VALUES)
+        else:
+            if role_names != MEMBER_ROLE_SET:
+                return None
+            correct_roles += len(roles_by_user[member['user_id']])
+    return correct_roles
+
+def queue_role_insert(mongo_docs, user_id, role_name, team_id, current_time):
+    """
+    Queues a role for creation. Its ObjectId is generated client-side so the
+    PostgreSQL row can reuse it without reading it back.
+
+    Args:
+        mongo_docs (list): Role documents to create, appended to in place.
+        user_id (str): The user the role belongs to.
+        role_name (str): The role's name.
+        team_id (str): The team the role is scoped to.
+        current_time (datetime): The role's creation time.
+    """
+    mongo_docs.append({
+        "_id": ObjectId(),
+        "user_id": user_id,
+        "role_name": role_name,
+        "scope": 'TEAM',
+        "team_id": team_id,
+        "is_active": True,
+        "created_by": "system",
+        "created_at": current_time
+    })
+
+def audit_owner_roles(owner_id, owner_roles, team_id, current_time, dry_run, counts, report, mongo_docs):
+    """
+    Checks that a team's creator holds every team role and queues the missing ones.
+
+    Args:
+        owner_id (str): The team creator's user_id.
+        owner_roles (list): The creator's active role documents in the team.
+        team_id (str): The team's id.
+        current_time (datetime): The creation time for queued roles.
+        dry_run (bool): If True, only report the roles that would be created.
+        counts (Counter): The team's processed role counts, updated in place.
+        report (TeamReport): The team's report.
+        mongo_docs (list): Role documents to create, appended to in place.
+    """
+    report.debug("  Verifying Owner roles for User: %s", owner_id)
+    have_roles = {existing['role_name'] for existing in owner_roles}
+    for role_value in TEAM_ROLE_VALUES:
+        if role_value in have_roles:
+            if dry_run:
+                report.debug("    [SKIP] Would skip Role '%s'. Role already exists.", role_value)
+            else:
+                report.debug("    [SKIP] Role '%s' already exists.", role_value)
+            counts['skipped'] += 1
+            continue
+        if dry_run:
+            report.debug("    [CREATE] Would create missing role '%s'.", role_value)
+            counts['created'] += 1
+            continue
+        report.debug("    [CREATE] Queueing missing role '%s'...", role_value)
+        queue_role_insert(mongo_docs, owner_id, role_value, team_id, current_time)
+
+def audit_member_roles(user_id, user_roles, team_id, current_time, dry_run, counts, report, mongo_docs, stale_roles):
+    """
+    Checks that a non-creator member holds only the member role, queueing the
+    missing member role and any other role for deletion.
+
+    Args:
+        user_id (str): The member's user_id.
+        user_roles (list): The member's active role documents in the team.
+        team_id (str): The team's id.
+        current_time (datetime): The creation time for queued roles.
+        dry_run (bool): If True, only report the changes that would be made.
+        counts (Counter): The team's processed role counts, updated in place.
+        report (TeamReport): The team's report.
+        mongo_docs (list): Role documents to create, appended to in place.
+        stale_roles (list): Role documents to delete, appended to in place.
+    """
+    report.debug("  Verifying Member roles for User: %s", user_id)
+    has_member_role = False
+    for role in user_roles:
+        if role["role_name"] == MEMBER_ROLE:
+            has_member_role = True
+            if dry_run:
+                report.debug("    [SKIP] Would skip Role '%s'. Role already exists.", role['role_name'])
+            else:
+                report.debug("    [SKIP] Skipped Role '%s'. Role already exists.", role['role_name'])
+            counts['skipped'] += 1
+        elif dry_run:
+            report.debug("    [DELETE] Would delete incorrect role '%s' for User: %s", role['role_name'], user_id)
+            counts['deleted'] += 1
+        else:
+            report.debug("    [DELETE] Queueing incorrect role '%s' for deletion for User: %s...", role['role_name'], user_id)
+            stale_roles.append(role)
+    if has_member_role:
+        return
+    if dry_run:
+        report.debug("    [CREATE] Would create missing 'member' role for User: %s", user_id)
+        counts['created'] += 1
+        return
+    report.debug("    [CREATE] Queueing missing 'member' role for User: %s...", user_id)
+    queue_role_insert(mongo_docs, user_id, MEMBER_ROLE, team_id, current_time)
+
+def process_team(team, team_member_details, roles_by_user, current_time, dry_run=True):
+    """
+    Audits and fixes the roles of every member of a single team.
+
+    Args:
+        team (dict): The team document.
+        team_member_details (list): The team's user_team_details documents.
+        roles_by_user (defaultdict): The team's active role documents, keyed by user_id.
+        current_time (datetime): The batch's timestamp, used as created_at and
+                                 last_sync_at for every role the team creates.
+        dry_run (bool): If True, only report the changes that would be made.
+
+    Returns:
+        tuple: A Counter of processed roles and the report lines for the team.
+    """
+    counts = Counter()
+    report = TeamReport()
+    user_roles_collection = mongo_client[MONGO_DB_NAME]['user_roles']
+    team_id = str(team['_id'])
+    report.debug("\nProcessing Team: %s", team_id)
+    mongo_docs = []
+    stale_roles = []
+    # Most teams are already correct; recognise them up front and skip the per-role audit
+    correct_roles = count_correct_roles(team, team_member_details, roles_by_user)
+    if correct_roles is not None:
+        report.debug("  [SKIP] All %s role(s) already correct.", correct_roles)
+        counts['skipped'] += correct_roles
+        return counts, report
+    owner_id = team['created_by']
+    member_ids = {member['user_id'] for member in team_member_details}
+    if owner_id in member_ids:
+        audit_owner_roles(
+            owner_id, roles_by_user[owner_id], team_id, current_time, dry_run, counts, report, mongo_docs
+        )
+    for member in team_member_details:
+        if member['user_id'] == owner_id:
+            continue
+        audit_member_roles(
+            member['user_id'], roles_by_user[member['user_id']], team_id, current_time, dry_run,
+            counts, report, mongo_docs, stale_roles
+        )
+
+    if dry_run or not (mongo_docs or stale_roles):
+        return counts, report
+
+    # The team borrows a pooled connection and returns it once its writes are done
+    pg_conn = None
+    try:
+        pg_conn = pg_pool.getconn()
+        # All of the team's PostgreSQL changes run in one transaction, committed when
+        # the block exits cleanly and rolled back if anything in it raises.
+        with pg_conn, pg_conn.cursor() as pg_cursor:
+            # PostgreSQL deletes run first so that a failed MongoDB write rolls them back.
+            # They are sent together rather than one round-trip per role.
+            pg_delete_params = [
+                (role["user_id"], team_id, role["role_name"], 'TEAM') for role in stale_roles
+            ]
+            psycopg2.extras.execute_batch(
+                pg_cursor, "EXECUTE delete_team_role (%s, %s, %s, %s)", pg_delete_params
+            )
+
+            # The PostgreSQL inserts run inside the MongoDB transaction's callback, so a
+            # PostgreSQL failure aborts it; PostgreSQL commits once MongoDB has committed.
+            apply_changes = partial(
+                apply_team_changes, pg_cursor, user_roles_collection, stale_roles, mongo_docs
+            )
+            if mongo_supports_transactions:
+                with mongo_client.start_session() as session:
+                    pg_rows = session.with_transaction(apply_changes)
+            else:
+                pg_rows = apply_changes()
+        counts['deleted'] += len(stale_roles)
+        counts['created'] += len(pg_rows)
+        report.debug("  [DELETE] Deleted %s incorrect role(s) for Team: %s", len(stale_roles), team_id)
+        report.debug("  [CREATE] Created %s missing role(s) for Team: %s", len(pg_rows), team_id)
+    except Exception as e:
+        report.error("  [ERROR] Failed to apply role changes for Team: %s. Reason: %s", team_id, e)
+        counts['error'] += 1
+    finally:
+        if pg_conn:
+            pg_pool.putconn(pg_conn)
+    return counts, report
+
+def copy_field(value):
+    """
+    Formats a value as a field of PostgreSQL's COPY text format.
+
+    Args:
+        value: A column value from a role row.
+
+    Returns:
+        str: The value with tabs, newlines and backslashes escaped.
+    """
+    if value is None:
+        return r'\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+@lru_cache(maxsize=COPY_MIN_ROWS)
+def build_insert_sql(row_count):
+    """
+    Builds a multi-row INSERT with placeholders for exactly `row_count` role
+    rows. Statements are cached per row count, so each batch size is only
+    generated once and its rows bind straight into the flattened parameters.
+
+    Args:
+        row_count (int): The number of rows the statement inserts.
+
+    Returns:
+        str: The INSERT statement.
+    """
+    row_placeholders = "(" + ", ".join(["%s"] * len(PG_ROLE_COLUMNS)) + ")"
+    return (
+        f"INSERT INTO postgres_user_roles ({', '.join(PG_ROLE_COLUMNS)}) VALUES "
+        + ", ".join([row_placeholders] * row_count)
+        + ";"
+    )
+
+def insert_pg_roles(pg_cursor, pg_rows):
+    """
+    Inserts role rows into postgres_user_roles. Large batches are streamed
+    with COPY FROM STDIN, which skips per-row statement overhead; small ones
+    use a multi-row INSERT, where COPY's setup cost isn't worth paying.
+
+    Args:
+        pg_cursor (cursor): A cursor in the team's open transaction.
+        pg_rows (list): Tuples of column values in PG_ROLE_COLUMNS order.
+    """
+    if len(pg_rows) < COPY_MIN_ROWS:
+        pg_cursor.execute(build_insert_sql(len(pg_rows)), list(chain.from_iterable(pg_rows)))
+        return
+    buffer = io.StringIO()
+    for row in pg_rows:
+        buffer.write('\t'.join(copy_field(value) for value in row) + '\n')
+    buffer.seek(0)
+    pg_copy_sql = f"COPY postgres_user_roles ({', '.join(PG_ROLE_COLUMNS)}) FROM STDIN;"
+    pg_cursor.copy_expert(pg_copy_sql, buffer)
+
+def apply_team_changes(pg_cursor, user_roles_collection, stale_roles, mongo_docs, session=None):
+    """
+    Applies a team's MongoDB writes and inserts the roles they created into
+    PostgreSQL. It is the MongoDB transaction's callback, so a PostgreSQL error
+    aborts the MongoDB transaction before it commits. The inserts run behind a
+    savepoint because with_transaction() may call it again on a transient error.
+
+    Args:
+        pg_cursor (cursor): A cursor in the team's open PostgreSQL transaction.
+        user_roles_collection (Collection): The user_roles collection.
+        stale_roles (list): Role documents to delete.
+        mongo_docs (list): Role documents to create if they don't exist yet.
+        session (ClientSession): The session of the enclosing transaction, if any.
+
+    Returns:
+        list: The PostgreSQL rows inserted for the roles that were created.
+    """
+    pg_cursor.execute("SAVEPOINT team_roles;")
+    try:
+        inserted = apply_mongo_changes(user_roles_collection, stale_roles, mongo_docs, session=session)
+        # Only roles that were really inserted (not created concurrently) are mirrored
+        pg_rows = []
+        for index in inserted:
+            doc = mongo_docs[index]
+            pg_rows.append(
+                (str(doc['_id']), doc['user_id'], doc['role_name'], 'TEAM', doc['team_id'],
+                 True, doc['created_at'], 'system', 'SYNCED', doc['created_at'])
+            )
+        if pg_rows:
+            insert_pg_roles(pg_cursor, pg_rows)
+    except Exception:
+        pg_cursor.execute("ROLLBACK TO SAVEPOINT team_roles;")
+        raise
+    pg_cursor.execute("RELEASE SAVEPOINT team_roles;")
+    return pg_rows
+
+def apply_mongo_changes(user_roles_collection, stale_roles, mongo_docs, session=None):
+    """
+    Deletes a team's incorrect roles and upserts its missing ones in MongoDB.
+
+    Args:
+        user_roles_collection (Collection): The user_roles collection.
+        stale_roles (list): Role documents to delete.
+        mongo_docs (list): Role documents to create if they don't exist yet.
+        session (ClientSession): The session of the enclosing transaction, if any.
+
+    Returns:
+        list: The indexes in `mongo_docs` of the roles that were actually inserted.
+    """
+    if stale_roles:
+        user_roles_collection.delete_many(
+            {'_id': {'$in': [role['_id'] for role in stale_roles]}},
+            session=session
+        )
+    if not mongo_docs:
+        return []
+    operations = [
+        UpdateOne(
+            {key: doc[key] for key in ('user_id', 'team_id', 'scope', 'role_name', 'is_active')},
+            {'$setOnInsert': {key: doc[key] for key in ('_id', 'created_by', 'created_at')}},
+            upsert=True
+        )
+        for doc in mongo_docs
+    ]
+    result = user_roles_collection.bulk_write(operations, ordered=False, session=session)
+    return sorted(result.upserted_ids)
+
+def load_team_batch(teams_batches, user_team_details_collection, user_roles_collection):
+    """
+    Takes the next batch of teams and fetches all of their members, and all of
+    their active roles, with one query each. The audit then only does in-memory
+    lookups instead of a role query per team.
+
+    Args:
+        teams_batches (iterator): Yields lists of team documents.
+        user_team_details_collection (Collection): The user_team_details collection.
+        user_roles_collection (Collection): The user_roles collection.
+
+    Returns:
+        tuple: The batch's teams and, in the same order, each team's member
+               documents and its active roles grouped by user_id. All three
+               lists are empty once the teams are exhausted.
+    """
+    teams_batch = next(teams_batches, [])
+    team_ids = [str(team['_id']) for team in teams_batch]
+    members_by_team = defaultdict(list)
+    roles_by_team = defaultdict(lambda: defaultdict(list))
+    if team_ids:
+        members_cursor = user_team_details_collection.find(
+            {"team_id": {"$in": team_ids}}, projection={'user_id': 1, 'team_id': 1}
+        ).batch_size(MEMBERS_BATCH_SIZE)
+        for member in members_cursor:
+            members_by_team[member["team_id"]].append(member)
+        # Ex-members' roles come back too but are never looked up; filtering them out
+        # here would need an unbounded $in of every member's user_id in the batch
+        roles_cursor = user_roles_collection.find(
+            {'team_id': {'$in': team_ids}, 'scope': 'TEAM', 'is_active': True},
+            projection={'user_id': 1, 'team_id': 1, 'role_name': 1}
+        ).batch_size(ROLES_BATCH_SIZE)
+        for role in roles_cursor:
+            roles_by_team[role['team_id']][role['user_id']].append(role)
+    return (
+        teams_batch,
+        [members_by_team[team_id] for team_id in team_ids],
+        [roles_by_team[team_id] for team_id in team_ids],
+    )
+
+def find_lingering_roles(user_roles_collection):
+    """
+    Finds the active team roles whose user is no longer a member of the team.
+    user_team_details is joined on team_id with localField/foreignField, and the
+    sub-pipeline keeps at most one membership of the role's user, so each role
+    carries an empty or single-entry array whatever the team's size. Combining
+    localField/foreignField with a pipeline needs MongoDB 5.0 or later.
+
+    Args:
+        user_roles_collection (Collection): The user_roles collection.
+
+    Returns:
+        CommandCursor: The lingering role documents.
+    """
+    return user_roles_collection.aggregate(
+        [
+            {'$match': {'is_active': True, 'scope': 'TEAM'}},
+            {'$lookup': {
+                'from': 'user_team_details',
+                'localField': 'team_id',
+                'foreignField': 'team_id',
+                'let': {'user_id': '$user_id'},
+                'pipeline': [
+                    {'$match': {'$expr': {'$eq': ['$user_id', '$$user_id']}}},
+                    {'$limit': 1},
+                    {'$project': {'_id': 1}}
+                ],
+                'as': 'membership'
+            }},
+            {'$match': {'membership': {'$size': 0}}},
+            {'$project': {'_id': 1, 'user_id': 1, 'team_id': 1, 'role_name': 1}}
+        ],
+        batchSize=ROLES_BATCH_SIZE
+    )
+
+def ensure_indexes(mongo_db):
+    """
+    Creates the compound indexes backing the role and membership lookups so
+    they are served by index scans rather than collection scans. Creating an
+    index that already exists is a no-op, so this is safe across runs.
+
+    Args:
+        mongo_db (Database): The MongoDB database holding the collections.
+    """
+    # team_id leads because the batched role fetch filters on team_id alone; the
+    # upsert filters on all five fields and is served by the same index.
+    mongo_db['user_roles'].create_index(
+        [('team_id', 1), ('user_id', 1), ('scope', 1), ('is_active', 1), ('role_name', 1)],
+        background=True
+    )
+    # Also backs Phase 2's $lookup on team_id
+    mongo_db['user_team_details'].create_index(
+        [('team_id', 1), ('user_id', 1)],
+        background=True
+    )
+
+def run_data_fix(dry_run=True, workers=DEFAULT_WORKERS):
     """
     Connects to MongoDB and PostgreSQL to find and fix corrupted data.
 
     Args:
         dry_run (bool): If True, the script will only report the changes it
                         would make without executing them.
+        workers (int): Number of threads auditing teams in parallel, capped at
+                       PG_POOL_MAX_CONN. 1 audits teams one at a time.
     """
     if dry_run:
-        print("--- RUNNING IN DRY-RUN MODE. NO CHANGES WILL BE MADE. ---")
+        log.info("--- RUNNING IN DRY-RUN MODE. NO CHANGES WILL BE MADE. ---")
     else:
-        print("--- RUNNING IN LIVE MODE. CHANGES WILL BE APPLIED. ---")
+        log.info("--- RUNNING IN LIVE MODE. CHANGES WILL BE APPLIED. ---")
         input("Press ENTER to continue or CTRL+C to abort...")
 
-    mongo_client = None
-    pg_conn = None
-    
-    created_count = 0
-    skipped_count = 0
-    deleted_count = 0
-    deactivated_count = 0
-    error_count = 0
+    # Each auditing thread holds at most one pooled PostgreSQL connection at a time
+    workers = min(workers, PG_POOL_MAX_CONN)
+    totals = Counter()
     
     try:
         # --- 1. Connect to Databases ---
-        print("\nConnecting to MongoDB...")
-        mongo_client = pymongo.MongoClient(MONGO_URI)
+        log.info("\nConnecting to MongoDB and PostgreSQL...")
+        open_connections()
         mongo_db = mongo_client[MONGO_DB_NAME]
-        print("MongoDB connection successful.")
+        log.info("MongoDB and PostgreSQL connections successful.")
+        if not dry_run:
+            log.info("\nEnsuring MongoDB indexes...")
+            ensure_indexes(mongo_db)
+            log.info("MongoDB indexes ready.")
         teams_collection = mongo_db['teams']
         user_team_details_collection = mongo_db['user_team_details']
         user_roles_collection = mongo_db['user_roles']
-
-        print("\nConnecting to PostgreSQL...")
-        pg_conn = psycopg2.connect(
-            dbname=PG_DB_NAME,
-            user=PG_USER,
-            password=PG_PASSWORD,
-            host=PG_HOST,
-            port=PG_PORT
-        )
-        pg_cursor = pg_conn.cursor()
-        print("PostgreSQL connection successful.")
-        print("\n")
+        log.info("\n")
         # --- 2. Identify Corrupted Data ---
-        print("\n--- Phase 1: Auditing roles for current team members ---")
-        teams_data = list(teams_collection.find({}))
-        teams_creator_id = []
-        roles_scope = 'TEAM'
-        
-        for teams in teams_data:
-            team_id = str(teams['_id'])
-            team_member_details = list(user_team_details_collection.find({"team_id": team_id}))
-            print(f"\nProcessing Team: {team_id}")
-            for member in team_member_details:
-                if member["user_id"] == teams["created_by"]:
-                    teams_creator_id = teams['created_by']
-                    print(f"  Verifying Owner roles for User: {member["user_id"]}")
-                    for role in TeamRole:
-                        try:
-                            query_filter = {
-                                'user_id': teams_creator_id,
-                                'team_id': team_id,
-                                'scope': roles_scope,
-                                'role_name': role.value,
-                                'is_active': True
-                            }
-                            result = list(user_roles_collection.find(query_filter))
-                        
-                            if dry_run:
-                                if result:
-                                    print(f"    [SKIP] Would skip Role '{role.value}'. Role already exists.")
-                                    skipped_count += 1
-                                    continue
-                                
-                                print(f"    [CREATE] Would create missing role '{role.value}'.")
-                                created_count += 1
-                                continue
-                            else:
-                                if result:
-                                    print(f"    [SKIP] Role '{role.value}' already exists.")
-                                    skipped_count += 1
-                                    continue
-                                print(f"    [CREATE] Creating missing role '{role.value}'...")
-                                current_time = datetime.now(timezone.utc)
-                                role_data = {
-                                    "user_id": teams_creator_id,
-                                    "role_name": role.value,
-                                    "scope": roles_scope,
-                                    "team_id": team_id,
-                                    "is_active": True,
-                                    "created_by": "system",
-                                    "created_at": current_time               
-                                }
-                                result = user_roles_collection.insert_one(role_data)
-                                mongo_id_str = str(result.inserted_id)
-                                pg_insert_sql = """
-                                    INSERT INTO postgres_user_roles (
-                                        mongo_id, user_id, role_name, scope, team_id, 
-                                        is_active, created_at, created_by, sync_status, last_sync_at
-                                    )
-                                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                                """
-                                pg_insert_params = (
-                                    mongo_id_str, teams_creator_id, role.value, 'TEAM', team_id, 
-                                    True, role_data['created_at'], 'system', 'SYNCED', current_time
-                                )
-                                pg_cursor.execute(pg_insert_sql, pg_insert_params)
-                                pg_conn.commit()
-                                created_count += 1
-                        except Exception as e:
-                            print(f"    [ERROR] Failed to process role '{role.value}' for owner {member["user_id"]}. Reason: {e}")
-                            error_count += 1
-                            if not dry_run: pg_conn.rollback()
-                            break
-                else:
-                    try:
-                        print(f"  Verifying Member roles for User: {member["user_id"]}")
-                        query_filter = {
-                                'user_id': member["user_id"],
-                                'team_id': team_id,
-                                'scope': roles_scope,
-                                'is_active': True
-                            }
-                        user_roles = list(user_roles_collection.find(query_filter))
-                        has_member_role = False
-                        for role in user_roles:
-                            if role["role_name"] == TeamRole.MEMBER.value:
-                                has_member_role = True
-                                if dry_run:
-                                    print(f"    [SKIP] Would skip Role '{role["role_name"]}'. Role already exists.")
-                                    skipped_count += 1
-                                    continue
-                                print(f"    [SKIP] Skipped Role '{role["role_name"]}'. Role already exists.")
-                                skipped_count += 1
-                            else:
-                                if dry_run:
-                                    print(f"    [DELETE] Would delete incorrect role '{role['role_name']}' for User: {member["user_id"]}")
-                                    deleted_count +=1
-                                    continue
-                                print(f"    [DELETE] Deleting incorrect role '{role['role_name']}' for User: {member["user_id"]}...")
-                                user_roles_collection.delete_one({"_id": role["_id"]})
-                                pg_delete_sql = """
-                                    DELETE FROM postgres_user_roles 
-                                    WHERE user_id=%s
-                                    AND team_id=%s
-                                    AND role_name=%s
-                                    AND scope=%s
-                                """
-                                pg_insert_params = (
-                                    member["user_id"], team_id, role["role_name"], 'TEAM' 
-                                )
-                                pg_cursor.execute(pg_delete_sql, pg_insert_params)
-                                pg_conn.commit()
-                                deleted_count += 1
-                                print(f"  - Deleted role '{role['role_name']}' for user {member['user_id']}")
-                        if not has_member_role:
-                            if dry_run:
-                                print(f"    [CREATE] Would create missing 'member' role for User: {member["user_id"]}")
-                                created_count += 1
-                                continue
-                            print(f"    [CREATE] Creating missing 'member' role for User: {member["user_id"]}...")
-                            current_time = datetime.now(timezone.utc)
-                            role_data = {
-                                "user_id": member["user_id"],
-                                "role_name": TeamRole.MEMBER.value,
-                                "scope": roles_scope,
-                                "team_id": team_id,
-                                "is_active": True,
-                                "created_by": "system",
-                                "created_at": current_time               
-                            }
-                            result = user_roles_collection.insert_one(role_data)
-                            mongo_id_str = str(result.inserted_id)
-                            pg_insert_sql = """
-                                INSERT INTO postgres_user_roles (
-                                    mongo_id, user_id, role_name, scope, team_id, 
-                                    is_active, created_at, created_by, sync_status, last_sync_at
-                                )
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                            """
-                            pg_insert_params = (
-                                mongo_id_str, member["user_id"], TeamRole.MEMBER.value, 'TEAM', team_id, 
-                                True, role_data['created_at'], 'system', 'SYNCED', current_time
-                            )
-                            pg_cursor.execute(pg_insert_sql, pg_insert_params)
-                            pg_conn.commit()
-                            fixed_count += 1
-                    except Exception as e:
-                        print(f"    [ERROR] Failed processing roles for member {member["user_id"]}. Reason: {e}")
-                        error_count += 1
-                        if not dry_run: pg_conn.rollback()
-                        break
-                    
-        print("\n--- Phase 2: Auditing for lingering roles (removed members) ---")
-        all_active_roles = list(user_roles_collection.find({'is_active': True, 'scope': 'TEAM'}))
-        for role in all_active_roles:
-            user_id = role["user_id"]
-            team_id = role["team_id"]
-            
-            user_still_member = user_team_details_collection.find_one({
-                "user_id": user_id,
-                "team_id": team_id
-            })
-            
-            if not user_still_member:
+        log.info("\n--- Phase 1: Auditing roles for current team members ---")
+        # Teams are independent and their audit is dominated by database round-trips,
+        # so threads sharing the client and pool overlap them. map() keeps results in
+        # team order so the report reads the same either way.
+        # A dry run only plans changes from the prefetched maps and makes no
+        # round-trips per team, so it is audited on the main thread.
+        executor = None
+        if workers > 1 and not dry_run:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        # The next batch's MongoDB reads run on a background thread, so their
+        # round-trips overlap with the workers' auditing.
+        reader = ThreadPoolExecutor(max_workers=1)
+        try:
+            # Stream teams in batches rather than loading the whole collection
+            teams_cursor = teams_collection.find(
+                {}, projection={'_id': 1, 'created_by': 1}
+            ).batch_size(TEAMS_BATCH_SIZE)
+            teams_batches = iter_batches(teams_cursor, TEAMS_BATCH_SIZE)
+            load_next_batch = partial(
+                load_team_batch, teams_batches, user_team_details_collection, user_roles_collection
+            )
+            next_batch = reader.submit(load_next_batch)
+            while True:
+                teams_batch, team_members, team_roles = next_batch.result()
+                if not teams_batch:
+                    break
+                # Prefetch the following batch while this one is audited
+                next_batch = reader.submit(load_next_batch)
+
+                # Teams without members have nothing to audit; keep them off the workers
+                populated_teams = [
+                    (team, members, roles)
+                    for team, members, roles in zip(teams_batch, team_members, team_roles)
+                    if members
+                ]
+                if not populated_teams:
+                    continue
+                # One timestamp for every role created in the batch
+                audit_team = partial(process_team, current_time=datetime.now(timezone.utc), dry_run=dry_run)
+                team_results = (executor.map if executor else map)(audit_team, *zip(*populated_teams))
+                for counts, report in team_results:
+                    report.emit()
+                    totals.update(counts)
+        finally:
+            reader.shutdown()
+            if executor:
+                executor.shutdown()
+
+        log.info("\n--- Phase 2: Auditing for lingering roles (removed members) ---")
+        # Dry runs only count lingering roles and never touch PostgreSQL
+        pg_conn = None if dry_run else pg_pool.getconn()
+        pg_cursor = None
+        try:
+            if pg_conn:
+                pg_cursor = pg_conn.cursor()
+            lingering_roles = find_lingering_roles(user_roles_collection)
+            # Deactivate lingering roles a batch at a time: one update per database
+            for lingering_batch in iter_batches(lingering_roles, ROLES_BATCH_SIZE):
+                for role in lingering_batch:
+                    if dry_run:
+                        log.debug("  [DEACTIVATE] Would deactivate lingering role '%s' for User: %s in Team: %s", role['role_name'], role['user_id'], role['team_id'])
+                    else:
+                        log.debug("  [DEACTIVATE] Deactivating lingering role '%s' for User: %s in Team: %s...", role['role_name'], role['user_id'], role['team_id'])
                 if dry_run:
-                    print(f"  [DEACTIVATE] Would deactivate lingering role '{role['role_name']}' for User: {member["user_id"]} in Team: {team_id}")
-                    deactivated_count += 1
+                    totals['deactivated'] += len(lingering_batch)
                     continue
-                else:
-                    print(f"  [DEACTIVATE] Deactivating lingering role '{role['role_name']}' for User: {member["user_id"]} in Team: {team_id}...")
-                    try:
-                        current_time = datetime.now(timezone.utc)
-                        
-                        # Deactivate in MongoDB
-                        user_roles_collection.update_one(
-                            {'_id': role["_id"]},
-                            {'$set': {'is_active': False}}
-                        )
-                        
-                        # Deactivate in PostgreSQL
-                        pg_update_sql = """
-                            UPDATE postgres_user_roles
-                            SET is_active = %s, last_sync_at = %s
-                            WHERE mongo_id = %s;
-                        """
-                        pg_cursor.execute(pg_update_sql, (False, current_time, str(role["_id"])))
-                        
-                        pg_conn.commit()
-                        deactivated_count += 1
-
-                    except Exception as e:
-                        print(f"  [ERROR] Failed to deactivate role {role['_id']}. Reason: {e}")
-                        error_count += 1
-                        pg_conn.rollback()
+                role_ids = [role["_id"] for role in lingering_batch]
+                try:
+                    current_time = datetime.now(timezone.utc)
+
+                    # Deactivate in PostgreSQL first, uncommitted, so that a failure on either
+                    # side leaves the batch active in both databases for a rerun to find
+                    pg_update_sql = """
+                        UPDATE postgres_user_roles
+                        SET is_active = %s, last_sync_at = %s
+                        WHERE mongo_id = ANY(%s::text[]);
+                    """
+                    pg_cursor.execute(pg_update_sql, (False, current_time, [str(role_id) for role_id in role_ids]))
+
+                    # Deactivate in MongoDB
+                    user_roles_collection.update_many(
+                        {'_id': {'$in': role_ids}}, {'$set': {'is_active': False}}
+                    )
+
+                    pg_conn.commit()
+                    totals['deactivated'] += len(role_ids)
+
+                except Exception as e:
+                    log.error("  [ERROR] Failed to deactivate %s lingering role(s). Reason: %s", len(role_ids), e)
+                    totals['error'] += 1
+                    pg_conn.rollback()
+        finally:
+            if pg_cursor:
+                pg_cursor.close()
+            if pg_conn:
+                pg_pool.putconn(pg_conn)
 
     except Exception as e:
-        print(f"\nA critical error occurred: {e}", file=sys.stderr)
-        if pg_conn and not dry_run:
-            pg_conn.rollback()
+        log.exception("\nA critical error occurred: %s", e)
     
     finally:
         # --- 4. Clean Up and Report ---
-        print("\n--- Final Summary ---")
-        print(f"Roles Created: {created_count}")
-        print(f"Roles Deleted: {deleted_count}")
-        print(f"Roles Deactivated: {deactivated_count}")
-        print(f"Roles Skipped (already correct): {skipped_count}")
-        print(f"Errors: {error_count}")
-        print("-----------------------")
-        if mongo_client:
-            mongo_client.close()
-            print("MongoDB connection closed.")
-        if pg_conn:
-            pg_conn.close()
-            print("PostgreSQL connection closed.")
+        if dry_run:
+            log.info("\n--- Dry-Run Plan (no changes were made) ---")
+        else:
+            log.info("\n--- Final Summary ---")
+        log.info("Roles Created: %s", totals['created'])
+        log.info("Roles Deleted: %s", totals['deleted'])
+        log.info("Roles Deactivated: %s", totals['deactivated'])
+        log.info("Roles Skipped (already correct): %s", totals['skipped'])
+        log.info("Errors: %s", totals['error'])
+        log.info("-----------------------")
+        close_connections()
+
+
+def positive_int(value):
+    """
+    Parses a command-line option that must be a whole number of at least 1.
+
+    Args:
+        value (str): The option's value as given on the command line.
 
+    Returns:
+        int: The parsed value.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -296,6 +783,28 @@ if __name__ == "__main__":
         action="store_true",
         help="Run the script without making any actual changes to the databases."
     )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=DEFAULT_WORKERS,
+        help="Number of threads auditing teams in parallel (1 audits teams one at a time)."
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Report every role checked, created, deleted or deactivated, not just the summary."
+    )
     args = parser.parse_args()
 
-    run_data_fix(dry_run=args.dry_run)
+    # Progress goes to stdout; warnings, errors and tracebacks go to stderr
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.WARNING)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(message)s",
+        handlers=[stdout_handler, stderr_handler]
+    )
+
+    run_data_fix(dry_run=args.dry_run, workers=args.workers)